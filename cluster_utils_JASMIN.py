@@ -22,21 +22,43 @@ import zarr
 import pickle
 import cartopy
 import dask
+import functools
+import os
+import dask.array as da
 from datetime import date
 
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.mixture import GaussianMixture
 
 from matplotlib.dates import DateFormatter
 from matplotlib.pyplot import cm
 from scipy import signal
-import scipy.stats as sts
+from scipy.optimize import linear_sum_assignment
+from scipy.special import logsumexp, softmax
 
 import sys
 sys.path.insert(0,'/home/users/eboland/python')
 import baspy as bp
 
 
+@functools.lru_cache(maxsize=None)
+def _open_dataset(dataVariableId, dataSourceId, tableId, experimentId, memberId):
+    """
+    Opens the CEDA files for one ensemble member, with dates formatted into np.datetime64.
+    Cached so repeated calls to retrieve_profiles reuse the same (lazy) dataset
+    """
+    df = bp.catalogue(dataset='cmip6',Var=dataVariableId,
+                      CMOR=tableId,Model=dataSourceId,
+                      Experiment=experimentId,RunID=memberId)
+
+    filesRaw = bp.open_dataset(df)
+
+    startDateIterate = np.datetime64(filesRaw['time'].values[0],'M')
+    endDateIterate = np.datetime64(filesRaw['time'].values[-1],'M') + np.timedelta64(1,'M')
+    filesRaw=filesRaw.assign_coords({'time':('time', np.arange(startDateIterate, endDateIterate, dtype='datetime64[M]')),
+                                     'time_bnds':('time_bnds', np.arange(startDateIterate, endDateIterate, dtype='datetime64[M]'))}) 
+    return filesRaw
+
 def retrieve_profiles(timeRange = slice('1965-01', '1994-12'), levSel=slice(100, 2000), maxLat = -30, mask = None, options = {}):
     """
   Create an xarray.DataArray of the temperature-depth profiles in the Southern Ocean. 
@@ -44,7 +66,10 @@ def retrieve_profiles(timeRange = slice('1965-01', '1994-12'), levSel=slice(100,
   :param timeRange: a slice or list of the times 
   :param levSel: a slice or list of the depths 
   :param maxLat: the maximum latitude
-  :param mask: a list of stacked ('i', 'j') coordinates to include, e.g. to remove NaN values
+  :param mask: a list of stacked ('i', 'j') coordinates to include, e.g. to remove NaN values, or the path of a .npy file
+  holding that list. If the file does not exist yet the mask is computed from the first time and maxLat and saved there.
+  A saved mask is only valid for the levSel, maxLat and model grid it was computed with, use a separate file for each.
+  A ValueError is raised if any point of a given mask is not on the grid or lies north of maxLat
   :param options: dictionary to select the ensemble. This function contains an additional option 'raw' which, if true, will cause
   this function to return unstacked data. In this case, the parameter mask is ignored
   :return: xarray.DataArray with coordinates ['time', 'n', 'lev'] (['time', 'lat', 'lon', 'lev'] if options['raw'])
@@ -61,16 +86,8 @@ def retrieve_profiles(timeRange = slice('1965-01', '1994-12'), levSel=slice(100,
   }
     options = {**options_default, **options}
     
-    df = bp.catalogue(dataset='cmip6',Var=options['dataVariableId'],
-                      CMOR=options['tableId'],Model=options['dataSourceId'],
-                      Experiment=options['experimentId'],RunID=options['memberId'])
-
-    filesRaw = bp.open_dataset(df)
-
-    startDateIterate = np.datetime64(filesRaw['time'].values[0],'M')
-    endDateIterate = np.datetime64(filesRaw['time'].values[-1],'M') + np.timedelta64(1,'M')
-    filesRaw=filesRaw.assign_coords({'time':('time', np.arange(startDateIterate, endDateIterate, dtype='datetime64[M]')),
-                                     'time_bnds':('time_bnds', np.arange(startDateIterate, endDateIterate, dtype='datetime64[M]'))}) 
+    filesRaw = _open_dataset(options['dataVariableId'], options['dataSourceId'], options['tableId'],
+                             options['experimentId'], options['memberId'])
 
     dataRaw = filesRaw.thetao
 
@@ -79,19 +96,59 @@ def retrieve_profiles(timeRange = slice('1965-01', '1994-12'), levSel=slice(100,
     except:
         pass
 
+    # the points south of maxLat only depend on the grid, so find them once rather than masking the data
+    below = (dataRaw['lat'] < maxLat).compute()
+
     with dask.config.set(**{'array.slicing.split_large_chunks': False}):
         
         data = dataRaw.sel(lev=levSel, time=timeRange)
-        data = data.where(data.lat < maxLat, drop=True)
         #data = data.squeeze()
         if options['raw']:
-            return data
-        data = data.stack(n=('i', 'j',))
-
-        # mask is a list of the values of n that are not NA
+            # same as data.where(data.lat < maxLat, drop=True)
+            keep = {dim : np.flatnonzero(below.any([d for d in below.dims if d != dim]).values) for dim in below.dims}
+            return data.isel(keep).where(below.isel(keep))
+        # chunk on time as in the store, with whole (i, j, lev) slabs per chunk, so that selecting the
+        # profiles is a gather within each chunk and random_sample does not need to rechunk n
+        # falling back to the current dask chunks (or one chunk for in-memory data) if the store does not say
+        time_chunk = dataRaw.encoding.get('preferred_chunks', {}).get('time')
+        if time_chunk is None:
+            time_chunk = data.chunksizes['time'][0] if data.chunks is not None else -1
+        data = data.chunk({'time' : time_chunk, 'i' : -1, 'j' : -1, 'lev' : -1})
+
+        # mask is a list of the ('i', 'j') values that are not NA
+        mask_file = None
+        mask_source = 'mask'
+        if isinstance(mask, (str, os.PathLike)):
+            mask_file = os.fspath(mask)
+            if not mask_file.endswith('.npy'):
+                mask_file = mask_file + '.npy'
+            mask = None
+            if os.path.exists(mask_file):
+                mask = np.load(mask_file, allow_pickle=True)
+                mask_source = 'mask loaded from {}'.format(mask_file)
         if mask is None:
-            mask = data.isel(time=0).dropna('n')['n'].values
-        data = data.sel(n=mask)
+            valid = (data.isel(time=0).notnull().all('lev') & below).transpose('i', 'j').values
+            inds_i, inds_j = np.nonzero(valid)
+            mask = pd.MultiIndex.from_arrays([data['i'].values[inds_i], data['j'].values[inds_j]]).values
+            if mask_file is not None:
+                np.save(mask_file, mask)
+                print('mask written to {}'.format(mask_file))
+
+        # pick the masked profiles pointwise from the (i, j) grid instead of stacking the whole domain
+        mask = pd.MultiIndex.from_tuples(np.asarray(mask), names=['i', 'j'])
+        mask_i = mask.get_level_values('i')
+        mask_j = mask.get_level_values('j')
+        inds_i = pd.Index(data['i'].values).get_indexer(mask_i)
+        inds_j = pd.Index(data['j'].values).get_indexer(mask_j)
+        if np.any(inds_i < 0) or np.any(inds_j < 0):
+            raise ValueError('{} contains (i, j) points that are not in the data'.format(mask_source))
+        if not np.all(below.transpose('i', 'j').values[inds_i, inds_j]):
+            raise ValueError('{} contains (i, j) points north of maxLat={}'.format(mask_source, maxLat))
+        data = data.isel(i=xr.DataArray(inds_i, dims='n'), j=xr.DataArray(inds_j, dims='n'))
+        data = data.assign_coords(i=('n', mask_i), j=('n', mask_j)).set_index(n=['i', 'j'])
+        data = data.transpose(..., 'n')
+        # area weights, computed once here and carried along to the classifications
+        data = data.assign_coords(coslat=np.cos(data['lat'] * np.pi/180))
 
     return data
 
@@ -106,18 +163,24 @@ def random_sample(data, N):
       :param N: the number of samples from each time 
       :return: xarray.DataArray with coordinates ['N', 'lev']
     """
+    if data.chunks is not None and len(data.chunksizes['n']) > 1:
+        data = data.chunk(dict(n=-1))
+
     rng = np.random.default_rng()
     def func(arr):
-        return rng.choice(arr, N, replace=False)
+        # independent draws without replacement for every time, gathered in one go
+        keys = rng.random(arr.shape[:-1])
+        inds = np.argpartition(keys, N - 1, axis=-1)[..., :N]
+        return np.take_along_axis(arr, inds[..., None], axis=-2)
 
     result = xr.apply_ufunc(
         func,
-        data.chunk(dict(n=-1)),
+        data,
         input_core_dims=[['n', 'lev']],
         output_core_dims=[['M', 'lev']],
         dask='parallelized',
         output_dtypes=('float64',),
-        vectorize=True,
+        vectorize=False,
         dask_gufunc_kwargs={
             'output_sizes' : {'M' : N}
         }
@@ -137,92 +200,151 @@ def normalise_data(data, dim=-1, return_inv=False):
     else:
         return (data - data.mean(dim)) / data.std(dim)
 
-def train_pca(data_sampled, n_components=3):
+def train_pca(data_sampled, n_components=3, incremental=None):
     """
       data_sampled (N, lev) returns pca object
+      If incremental, dask-backed samples are fitted chunk by chunk with an IncrementalPCA, so only one chunk is
+      held in memory at a time. This approximates the exact PCA, which needs the whole sample in driver memory.
+      By default (incremental=None) the IncrementalPCA is used for dask-backed samples larger than dask's
+      array.chunk-size, and the exact PCA for anything smaller
     """
 
-    pca = PCA(n_components)
-    arr = data_sampled.values
-    pca = pca.fit(arr)
+    arr = data_sampled.transpose('N', 'lev').data
+    if incremental is None:
+        chunk_size = dask.utils.parse_bytes(dask.config.get('array.chunk-size'))
+        incremental = isinstance(arr, da.Array) and arr.nbytes > chunk_size
+    if not (incremental and isinstance(arr, da.Array)):
+        pca = PCA(n_components)
+        pca = pca.fit(np.asarray(arr))
+        return pca
+
+    arr = arr.rechunk({0 : 'auto', 1 : -1})
+    # partial_fit needs at least n_components samples per batch, merge short blocks with their neighbour
+    chunks = []
+    for c in arr.chunks[0]:
+        if chunks and (c < n_components or chunks[-1] < n_components):
+            chunks[-1] += c
+        else:
+            chunks.append(c)
+    arr = arr.rechunk({0 : tuple(chunks)})
+
+    pca = IncrementalPCA(n_components)
+    for block in arr.to_delayed().ravel():
+        pca.partial_fit(dask.compute(block)[0])
     return pca
 
-def pca_transform(data, pca):
+def _rebatch(data, core_dim):
     """
-      Applies a transformation into PCA space
+    Merges dask chunks into blocks of about dask's array.chunk-size, with core_dim in a single chunk, so that
+    the per-block PCA/GMM evaluation runs on a few large batches rather than many small ones
     """
+    if data.chunks is None:
+        return data
+    return data.chunk({dim : (-1 if dim == core_dim else 'auto') for dim in data.dims})
 
-    lev_size = data.sizes['lev']
-    n_comp = pca.n_components
+def _apply_rows(data, core_dim, kernel, out_dim=None, out_size=None, fill=np.nan, dtype='float32'):
+    """
+    Applies kernel, which maps profiles (N, core_dim) to (N,) or (N, out_size), along core_dim of data.
+    Rows containing nan are not passed to kernel and are set to fill in the output
+    """
+    core_size = data.sizes[core_dim]
+    out_sizes = {} if out_dim is None else {out_dim : out_size}
 
     def func(arr):
-        arr_r = np.reshape(arr, (-1, lev_size))
-
-        inds = np.isnan(arr_r)
-        arr_r[inds] = 0
+        arr_r = np.reshape(arr, (-1, core_size)).astype('float32', copy=False)
+        valid = ~np.isnan(np.sum(arr_r, axis=1)) # rows without any nan
 
-        out = pca.transform(arr_r)
-        out[inds[..., 0:n_comp]] = np.nan
-        out_sizes = np.shape(arr[..., 0:n_comp])
-
-        out = np.reshape(out, out_sizes)
+        out = np.full((arr_r.shape[0],) + tuple(out_sizes.values()), fill, dtype=dtype)
+        out[valid] = kernel(arr_r[valid])
+        out = np.reshape(out, np.shape(arr)[:-1] + tuple(out_sizes.values()))
         return out
 
     result = xr.apply_ufunc(
             func,
-            data,
-            input_core_dims=[['lev']],
-            output_core_dims=[['pca_comp']],
+            _rebatch(data, core_dim),
+            input_core_dims=[[core_dim]],
+            output_core_dims=[list(out_sizes)],
             dask='parallelized',
-            output_dtypes=('float64',),
+            output_dtypes=(dtype,),
             vectorize=False,
             dask_gufunc_kwargs={
-              'output_sizes' : {'pca_comp' : n_comp},
+              'output_sizes' : out_sizes,
               'allow_rechunk' : True
             }
-
         )
 
     return result
 
+def _pca_params(pca):
+    """
+    Returns the mean and projection matrix (lev, pca_comp) of a fitted PCA, so that
+    (x - mean) @ components == pca.transform(x)
+    """
+    components = pca.components_.T
+    if pca.whiten:
+        components = components / np.sqrt(pca.explained_variance_)
+    return pca.mean_.astype('float32'), components.astype('float32')
+
+def pca_transform(data, pca):
+    """
+      Applies a transformation into PCA space
+    """
+
+    pca_mean, pca_components = _pca_params(pca)
+    def kernel(arr_r):
+        return (arr_r - pca_mean) @ pca_components
+
+    return _apply_rows(data, 'lev', kernel, out_dim='pca_comp', out_size=pca.n_components)
+
 def train_gmm(data_trans, K):
     """
-    Trains a GMM on the data
+    Trains a GMM on the data, in float64 so the fitted model and its BIC/AIC do not depend on the dtype of data_trans
     """
     gmm = GaussianMixture(K)
-    gmm.fit(data_trans.values)
+    gmm.fit(data_trans.values.astype('float64'))
     return gmm
 
+def _gmm_params(gmm):
+    """
+    Precomputes the quantities needed to evaluate a fitted GMM: the Cholesky factors of the precisions
+    as one (D, K*D) matrix, the means projected by them (K, D) and the log normalisation of each
+    component, log(weight) + log(det(precision_cholesky))
+    """
+    K, D = gmm.means_.shape
+    chol = gmm.precisions_cholesky_
+    if gmm.covariance_type == 'tied':
+        chol = np.broadcast_to(chol, (K, D, D))
+    elif gmm.covariance_type == 'diag':
+        chol = chol[:, :, None] * np.eye(D)
+    elif gmm.covariance_type == 'spherical':
+        chol = chol[:, None, None] * np.eye(D)
+    log_det = np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+    means_chol = np.einsum('kd,kde->ke', gmm.means_, chol)
+    chol_flat = np.reshape(np.transpose(chol, (1, 0, 2)), (D, K * D))
+    return chol_flat.astype('float32'), means_chol.astype('float32'), (log_det + np.log(gmm.weights_)).astype('float32')
+
+def _gmm_log_prob(arr_r, params):
+    """
+    Weighted log probabilities (N, K) of the samples arr_r (N, D) for each GMM component
+    """
+    chol_flat, means_chol, log_norm = params
+    K, D = means_chol.shape
+    # (x - mu_k) @ L_k for all components with a single matrix product
+    y = np.reshape(arr_r @ chol_flat, (-1, K, D)) - means_chol
+    log_prob = np.einsum('nkd,nkd->nk', y, y)
+    return -0.5 * (D * np.log(2 * np.pi) + log_prob) + log_norm
+
 def gmm_classify(data_trans, gmm):
   
     """
     Replace the nan with -1
     """
 
-    pca_size = data_trans.sizes['pca_comp']
-    def func(arr):
-        arr_r = np.reshape(arr, (-1, pca_size))
+    params = _gmm_params(gmm)
+    def kernel(arr_r):
+        return np.argmax(_gmm_log_prob(arr_r, params), axis=1)
 
-        inds = np.isnan(arr_r) 
-        arr_r[inds] = 0
-
-        out = gmm.predict(arr_r)
-        out_sizes = np.shape(arr[..., 0])
-        out[inds[:, 0]] = -1 #replaces the nan values with -1
-        out = np.reshape(out, out_sizes)
-        return out
-
-    result = xr.apply_ufunc(
-            func,
-            data_trans,
-            input_core_dims=[['pca_comp']],
-            output_core_dims=[[]],
-            dask='parallelized',
-            output_dtypes=('int',),
-            vectorize=False,
-        )
-
-    return result
+    return _apply_rows(data_trans, 'pca_comp', kernel, fill=-1, dtype='int')
 
 def gmm_prob(data_trans, gmm):
   
@@ -230,35 +352,11 @@ def gmm_prob(data_trans, gmm):
     Replace the nan with -1
     """
 
-    pca_size = data_trans.sizes['pca_comp']
-    gmm_size = gmm.n_components
-    def func(arr):
-        arr_r = np.reshape(arr, (-1, pca_size))
-
-        inds = np.isnan(arr_r) 
-        arr_r[inds] = 0
-
-        out = gmm.predict_proba(arr_r)
-        out_sizes = list(np.shape(arr))
-        out_sizes[-1] = gmm_size
-        out[inds[:, 0]] = np.nan
-        out = np.reshape(out, out_sizes)
-        return out
+    params = _gmm_params(gmm)
+    def kernel(arr_r):
+        return softmax(_gmm_log_prob(arr_r, params), axis=1)
 
-    result = xr.apply_ufunc(
-        func,
-        data_trans,
-        input_core_dims=[['pca_comp']],
-        output_core_dims=[['k']],
-        dask='parallelized',
-        output_dtypes=('float64',),
-        vectorize=False,
-        dask_gufunc_kwargs={
-            'output_sizes' : {'k' : gmm_size}
-        }
-    )
-  
-    return result
+    return _apply_rows(data_trans, 'pca_comp', kernel, out_dim='k', out_size=gmm.n_components)
 
   
 def gmm_score_samples(data_trans, gmm):
@@ -267,61 +365,62 @@ def gmm_score_samples(data_trans, gmm):
     Replace the nan with -1
     """
 
-    pca_size = data_trans.sizes['pca_comp']
-    gmm_size = gmm.n_components
-    def func(arr):
-        arr_r = np.reshape(arr, (-1, pca_size))
+    params = _gmm_params(gmm)
+    def kernel(arr_r):
+        return logsumexp(_gmm_log_prob(arr_r, params), axis=1)
 
-        inds = np.isnan(arr_r) 
-        arr_r[inds] = 0
+    return _apply_rows(data_trans, 'pca_comp', kernel)
 
-        out = gmm.score_samples(arr_r)
-        out_sizes = np.shape(arr)
-        out_sizes = out_sizes[0:-1]
-        out[inds[:, 0]] = np.nan
-        out = np.reshape(out, out_sizes)
-        return out
-
-    result = xr.apply_ufunc(
-            func,
-            data_trans,
-            input_core_dims=[['pca_comp']],
-            output_core_dims=[[]],
-            dask='parallelized',
-            output_dtypes=('float64',),
-            vectorize=False,
-            dask_gufunc_kwargs={
-                'output_sizes' : {}
-            }
-        )
-
-    return result
-
-def generate_trainingset(timeRange = slice('1965-01', '1994-12'), mask=None, options={},n_components=3,N=7000,**kwargs):
+def generate_trainingset(timeRange = slice('1965-01', '1994-12'), mask=None, options={},n_components=3,N=7000,incremental=None,**kwargs):
+    """
+    Returns a normalised random sample of N profiles per month transformed into PCA space, and the PCA fitted to it.
+    The sample and the transformed training set are persisted rather than computed. Unless incremental=False,
+    large samples are fitted with an IncrementalPCA (see train_pca) so the sample never has to fit in driver memory
+    """
     # Get profiles from googleapi CMIP6 data store
     data = retrieve_profiles(timeRange=timeRange,mask=mask,options=options,**kwargs)
     # Subset by chooseing N random profiles per month in the Southern Ocean
-    data_sampled = random_sample(data, N).compute()
-    # Normalise the samples
-    data_sampled = normalise_data(data_sampled, 'N') 
+    # persist rather than compute, the sample stays on the workers and is not redrawn at every step
+    data_sampled = random_sample(data, N).astype('float32').persist()
+    # Normalise the samples, replacing the reference so the unnormalised sample can be released
+    data_sampled = normalise_data(data_sampled, 'N').persist()
     #Fit PCA model  
-    pca = train_pca(data_sampled, n_components)   
-    # Transform training set to PCA space
-    data_trans = pca_transform(data_sampled, pca)
+    pca = train_pca(data_sampled, n_components, incremental=incremental)   
+    # Transform training set to PCA space, persisted as it is reused for every GMM fitted to it
+    data_trans = pca_transform(data_sampled, pca).persist()
     return data_trans,pca
 
+def _coslat(data):
+    """
+    cos(lat) area weights of data, taken from the coslat coordinate set by retrieve_profiles when present
+    """
+    if 'coslat' in data.coords:
+        return data['coslat']
+    return np.cos(data['lat'] * np.pi/180)
+
+def _bincount_rows(arr, K, weights=None):
+    """
+    (Weighted) counts of each class 0..K-1 along the last axis of arr, values outside that range (e.g. -1) are ignored.
+    weights must broadcast against arr. Returns an array of shape arr.shape[:-1] + (K,)
+    """
+    arr_r = np.reshape(arr, (-1, np.shape(arr)[-1]))
+    valid = (arr_r >= 0) & (arr_r < K)
+    # offset the classes of each row so a single bincount counts all rows
+    offsets = np.broadcast_to(np.arange(arr_r.shape[0])[:, None] * K, arr_r.shape)
+    inds = offsets[valid] + arr_r[valid].astype('int')
+    if weights is not None:
+        weights = np.reshape(np.broadcast_to(weights, np.shape(arr)), arr_r.shape)[valid]
+    counts = np.bincount(inds, weights=weights, minlength=arr_r.shape[0] * K)
+    return np.reshape(counts, np.shape(arr)[:-1] + (K,))
+
 def count_area(data_classes, K):
     """
     Counts the number of assignments for each class, weighted by the latitude. The result is proportional to the total ocean surface area
     of profiles assigned to each class
     """
-    lats = data_classes['lat'].values
-    cos_lats = np.cos(lats * np.pi / 180)
+    cos_lats = _coslat(data_classes).values
     def func(arr):
-        out = np.zeros(K)
-        for i in range(K):
-            out[i] = np.sum(cos_lats * (arr==i))
-    return out
+        return _bincount_rows(arr, K, weights=cos_lats)
 
     result = xr.apply_ufunc(
         func,
@@ -330,7 +429,7 @@ def count_area(data_classes, K):
         output_core_dims=[['k']],
         dask='parallelized',
         output_dtypes=('float64',),
-        vectorize=True,
+        vectorize=False,
         dask_gufunc_kwargs={
             'output_sizes' : {'k' : K}
         }
@@ -342,10 +441,9 @@ def mean_lat(data_classes, K):
     lats = data_classes['lat'].values
     # cos_lats = np.cos(lats * np.pi / 180)
     def func(arr):
-        out = np.zeros(K)
-        for i in range(K):
-            out[i] = np.mean(lats * (arr==i))
-    return out
+        sums = _bincount_rows(arr, K, weights=lats)
+        counts = _bincount_rows(arr, K)
+        return sums / np.where(counts > 0, counts, 1)
 
     result = xr.apply_ufunc(
         func,
@@ -354,7 +452,7 @@ def mean_lat(data_classes, K):
         output_core_dims=[['k']],
         dask='parallelized',
         output_dtypes=('float64',),
-        vectorize=True,
+        vectorize=False,
         dask_gufunc_kwargs={
             'output_sizes' : {'k' : K}
         }
@@ -371,14 +469,56 @@ def avg_profiles(data, data_classes, K):
     returns a list of dictionaries
     """
 
+    data_classes = data_classes.broadcast_like(data.isel(lev=0, drop=True))
+    data = data.transpose(*data_classes.dims, 'lev')
+    arr = data.data
+    if isinstance(arr, da.Array):
+        arr = arr.rechunk({arr.ndim - 1 : -1})
+
+    counts, sums, sqsums = _sum_blocks(_class_moments, arr, data_classes.data, K=K)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        d_m = sums / counts
+        d_var = (sqsums - sums * d_m) / (counts - 1)
+    d_std = np.sqrt(np.clip(d_var, 0, None))
+
     out = []
     for i in range(K):
-        d = data.where(data_classes==i)
-        d_m = d.mean(('time', 'n'), skipna=True).values
-        d_std = d.std(('time', 'n'), skipna=True, ddof=1).values
-        out.append({'mean' : d_m, 'std' : d_std})
+        out.append({'mean' : d_m[i], 'std' : d_std[i]})
     return out
 
+def _sum_blocks(func, arr, *others, **kwargs):
+    """
+    Sums func(arr, *others, **kwargs) over the chunks of arr, others share the leading dimensions of arr.
+    Dask arrays are reduced one chunk at a time, numpy arrays in a single call
+    """
+    if not any(isinstance(a, da.Array) for a in (arr,) + others):
+        return func(np.asarray(arr), *[np.asarray(a) for a in others], **kwargs)
+
+    arr = da.asarray(arr)
+    others = [da.asarray(a).rechunk(arr.chunks[:np.ndim(a)]) for a in others]
+    blocks = zip(*[a.to_delayed().ravel() for a in [arr] + others])
+    parts = [dask.delayed(func)(*b, **kwargs) for b in blocks]
+    return np.sum(dask.compute(*parts), axis=0)
+
+def _class_moments(arr, classes, K):
+    """
+    Counts, sums and sums of squares of arr (..., lev) for each class and level, ignoring nan and unassigned (-1) values
+    returns array of shape (3, K, lev)
+    """
+    lev_size = arr.shape[-1]
+    arr_r = np.reshape(arr, (-1, lev_size))
+    classes_r = np.reshape(classes, (-1, 1))
+
+    valid = (classes_r >= 0) & (classes_r < K) & ~np.isnan(arr_r)
+    inds = (classes_r.astype('int') * lev_size + np.arange(lev_size))[valid]
+    vals = arr_r[valid]
+
+    size = K * lev_size
+    out = np.stack([np.bincount(inds, minlength=size),
+                    np.bincount(inds, weights=vals, minlength=size),
+                    np.bincount(inds, weights=vals * vals, minlength=size)])
+    return np.reshape(out, (3, K, lev_size))
+
 def pca_sort(data_classes, gmm):
     """
     Returns a new array of class assignnments, with the classes now ordered by mean value of the first pca component
@@ -395,21 +535,23 @@ def match_profiles(avg0, avg1, dist=None):
     avg1: list of dict, profile means and std
     dist: dict, dict -> float64 distance between two profiles
     returns:
-    inds: array of indices that sorts the profiles in avg1 to match avg0
+    inds: array of indices that sorts the profiles in avg1 to match avg0, each profile is used exactly once
     """
     n_classes = len(avg0)
     assert n_classes == len(avg1)
-    norms = np.zeros((n_classes, n_classes))
-    for i in range(n_classes):
-        for j in range(n_classes):
-            if dist is None:
-                diff = avg0[i]['mean'] - avg1[j]['mean']
-                norms[i, j] = np.sum(diff * diff)
-                #norms[j, i] = norms[i, j]
-            else:
+    if dist is None:
+        means0 = np.vstack([d['mean'] for d in avg0])
+        means1 = np.vstack([d['mean'] for d in avg1])
+        diff = means0[:, None, :] - means1[None, :, :]
+        norms = np.sum(diff * diff, axis=-1)
+    else:
+        norms = np.zeros((n_classes, n_classes))
+        for i in range(n_classes):
+            for j in range(n_classes):
                 norms[i, j] = dist(avg0[i], avg1[j])
-                #norms[j, i] = norms[i, j]
-    return np.argmin(norms, axis=1)
+    # one-to-one assignment minimising the total distance
+    _, inds = linear_sum_assignment(norms)
+    return inds
 
 def match_spatial(data_classes, data_classes_ref, n_classes):
     """
@@ -421,9 +563,21 @@ def match_spatial(data_classes, data_classes_ref, n_classes):
     inds: array of indices that sorts the classes in data_classes
     """
 
-    counts = np.array([[((data_classes.where(data_classes_ref==k) == j) * np.cos(data_classes['lat'] * 3.1415/180)).sum(skipna=True) \
-                        for k in range(n_classes) ] for j in range(n_classes)])
-    return np.argmax(np.array(counts), axis=0)
+    data_classes, data_classes_ref = xr.broadcast(data_classes, data_classes_ref)
+    data_classes_ref = data_classes_ref.transpose(*data_classes.dims)
+    weights = _coslat(data_classes).broadcast_like(data_classes).transpose(*data_classes.dims)
+
+    counts = _sum_blocks(_class_cooccurrence, data_classes.data, data_classes_ref.data, weights.data, K=n_classes)
+    return np.argmax(counts, axis=0)
+
+def _class_cooccurrence(classes, classes_ref, weights, K):
+    """
+    Weighted counts (K, K) of profiles assigned to class j in classes and class k in classes_ref
+    """
+    valid = (classes >= 0) & (classes < K) & (classes_ref >= 0) & (classes_ref < K)
+    inds = classes[valid].astype('int') * K + classes_ref[valid].astype('int')
+    counts = np.bincount(inds, weights=weights[valid], minlength=K * K)
+    return np.reshape(counts, (K, K))
 
 
 def temp_sort(data_classes, avg, arg=False):
@@ -438,13 +592,15 @@ def temp_sort(data_classes, avg, arg=False):
         return reorder(data_classes, inds)
 
 def reorder(data_classes, inds):
-    inds_r = np.zeros(np.shape(inds))
-    inds_r[inds] = np.arange(0, np.size(inds), dtype='int')
+    # lookup table from old to new class, the extra last entry maps -1 (unassigned) to itself
+    lut = np.full(np.size(inds) + 1, -1, dtype='int')
+    lut[inds] = np.arange(0, np.size(inds), dtype='int')
 
     def func(arr):
-        out = inds_r[arr.astype('int')]
-        out[arr == -1] = -1
-        return out
+        # integer labels index the table directly, only float labels need casting
+        if not np.issubdtype(arr.dtype, np.integer):
+            arr = arr.astype('int')
+        return lut[arr]
 
     result = xr.apply_ufunc(
         func,
@@ -461,10 +617,17 @@ def reorder(data_classes, inds):
 
     return result
 
-def modal_classes(data_classes,dims=['time',]):
+def modal_classes(data_classes,dims=['time',],K=None):
+    """
+    Returns the most frequent class along dims, ignoring unassigned (-1) profiles. Profiles that are never assigned return -1.
+    K, the number of classes, is inferred from the data if not given
+    """
   
     def func(arr):
-        return sts.mode(arr)[0]
+        n_classes = K or max(int(np.nanmax(arr, initial=-1)) + 1, 1)
+        counts = _bincount_rows(arr, n_classes)
+        out = np.where(np.sum(counts, axis=-1) == 0, -1, np.argmax(counts, axis=-1)).astype('float64')
+        return out
 
     if len(dims)>1:
         data_classes=data_classes.stack(indim=dims)
@@ -478,7 +641,7 @@ def modal_classes(data_classes,dims=['time',]):
         output_core_dims=[[]],
         dask='parallelized',
         output_dtypes=('float64',),
-        vectorize=True,
+        vectorize=False,
         dask_gufunc_kwargs={
           'output_sizes' : {},
           'allow_rechunk' : True